@@ -1,11 +1,17 @@
+import selectors
 import socket
 import sys
 import os
+import mmap
+import multiprocessing
 import random
 import time
 from protocol import *
+from netio import RecvSlots, send_batch, recv_batch
 
 TIMEOUT = 2.0
+SOCKET_BUFFER_SIZE = 4 << 20  # 4 MB kernel send/receive buffers
+RECV_BATCH = 64  # max ACKs drained per wakeup
 host = "127.0.0.1"
 port = 8080
 
@@ -13,6 +19,9 @@ class UDPClient:
     def __init__(self, host, port):
         self.server_addr = (host, port)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Large kernel buffers so a full window (and its ACKs) never overruns them
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
         self.sock.settimeout(TIMEOUT)
         
         # generate a random session id for this connection
@@ -39,6 +48,10 @@ class UDPClient:
                     
                 if packet.msg_type == TYPE_SYN_ACK:
                     print(f"[*] Received SYN-ACK. Connection established.")
+                    # The server assigns the session ID used from here on ("OK|<session_id>")
+                    _, _, assigned = packet.payload.decode('utf-8').partition('|')
+                    if assigned:
+                        self.session_id = int(assigned)
                     # Store the server's SYN-ACK seq separately.
                     # Client and server maintain independent sequence counters.
                     self.server_seq = packet.seq_num
@@ -60,6 +73,7 @@ class UDPClient:
         # Server's first DATA packet has seq = server's SYN-ACK seq + 1.
         # (Client and server have independent sequence counters.)
         expected_seq = self.server_seq + 1
+        acks = AckTemplate(self.session_id)
         
         with open("downloaded_" + os.path.basename(filename), 'wb') as f:
             while True:
@@ -79,14 +93,12 @@ class UDPClient:
                         if packet.seq_num == expected_seq:
                             # Write data and send ACK
                             f.write(packet.payload)
-                            ack_pkt = Packet(TYPE_ACK, packet.seq_num, self.session_id)
-                            self.sock.sendto(ack_pkt.to_bytes(), self.server_addr)
+                            self.sock.sendto(acks.build(packet.seq_num), self.server_addr)
                             expected_seq += 1
                         elif packet.seq_num < expected_seq:
                              # Duplicate packet, resend ACK
                              print(f"[!] Duplicate DATA seq {packet.seq_num}, resending ACK")
-                             ack_pkt = Packet(TYPE_ACK, packet.seq_num, self.session_id)
-                             self.sock.sendto(ack_pkt.to_bytes(), self.server_addr)
+                             self.sock.sendto(acks.build(packet.seq_num), self.server_addr)
                              
                     elif packet.msg_type == TYPE_FIN:
                         print(f"[*] Received FIN. Closing connection.")
@@ -106,74 +118,117 @@ class UDPClient:
                 except ValueError as e:
                     print(f"[!] Parsing error: {e}")
 
-    def upload_file(self, filename, window_size=4):
-        """Upload a file using a Go-Back-N sliding window (window_size packets in flight)."""
+    def upload_file(self, filename, window_size=4, segment=None):
+        """
+        Upload a file using a Selective Repeat sliding window (window_size packets in flight).
+        If segment is an (offset, length) pair, only that byte range is uploaded, and the
+        server writes it at the same offset (see parallel_upload).
+        Returns True once the server has acknowledged the whole upload, False otherwise.
+        """
         if not os.path.exists(filename):
             print(f"[!] File not found: {filename}")
-            return
+            return False
             
         print(f"[*] Starting upload of '{filename}' (window_size={window_size})...")
-        if not self.connect("UPLOAD", os.path.basename(filename)):
-            return
+        if segment is None:
+            connected = self.connect("UPLOAD", os.path.basename(filename))
+        else:
+            # Segment SYN: "UPLOAD_SEG|offset|total_size|filename"
+            target = f"{segment[0]}|{os.path.getsize(filename)}|{os.path.basename(filename)}"
+            connected = self.connect("UPLOAD_SEG", target)
+        if not connected:
+            return False
             
         # Client's first data packet = SYN seq + 1 (our own counter, not server's).
         # Server's expected_seq for upload is also packet.seq_num + 1 = SYN seq + 1. ✓
         self.seq_num += 1  # First data packet = SYN seq + 1
         
-        # Read all chunks up-front (or lazily via a deque for large files)
+        # Map the file instead of reading it into a list of chunks: each packet's
+        # payload is a zero-copy slice served from the page cache on demand.
         with open(filename, 'rb') as f:
-            chunks = []
-            while True:
-                chunk = f.read(MAX_PAYLOAD_SIZE)
-                if not chunk:
-                    break
-                chunks.append(chunk)
+            filesize = os.fstat(f.fileno()).st_size
+            # mmap cannot map an empty file
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if filesize else b""
+        mv = memoryview(mm)
+        if segment is not None:
+            offset, length = segment
+            mv = mv[offset:offset + length]
         
-        total_chunks = len(chunks)
+        total_chunks = (len(mv) + MAX_PAYLOAD_SIZE - 1) // MAX_PAYLOAD_SIZE
         base = 0          # index of oldest unacknowledged packet
         next_idx = 0      # index of next packet to send
-        base_seq = self.seq_num  # seq_num corresponding to chunks[0]
+        base_seq = self.seq_num  # seq_num corresponding to the first chunk
         
-        # Pre-build all packets
-        packets = []
-        for i, chunk in enumerate(chunks):
-            packets.append(Packet(TYPE_DATA, base_seq + i, self.session_id, chunk))
+        # Pre-build all packets in one comprehension over the mapping; locals
+        # avoid a global/attribute lookup per packet
+        P, T, sid, M = Packet, TYPE_DATA, self.session_id, MAX_PAYLOAD_SIZE
+        packets = [P(T, base_seq + i, sid, mv[i * M:(i + 1) * M]) for i in range(total_chunks)]
         
-        self.sock.settimeout(TIMEOUT)
-        last_send_time = time.time()
+        # Wire bytes per packet, serialized once when the packet first enters the
+        # window and dropped once it is ACKed, so only about a window's worth of
+        # file data is ever copied out of the mapping at a time
+        wire = [None] * total_chunks
+        
+        acked = set()                  # indices ACKed individually, ahead of base
+        send_time = [0.0] * total_chunks  # per-packet retransmission timers
+        
+        # Wake on readability instead of blocking in recvfrom, so every ACK that
+        # arrived (even mid-burst) is drained in one go before refilling the window
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        recv_slots = RecvSlots(RECV_BATCH, MAX_PAYLOAD_SIZE + HEADER_SIZE)
         
         while base < total_chunks:
             # Fill the window — send any unsent packets within base..base+window_size
+            # as one batch (a single sendmmsg syscall where available)
+            batch = []
+            now = time.time()
             while next_idx < total_chunks and next_idx < base + window_size:
-                print(f"[>] Sending DATA seq {packets[next_idx].seq_num} ({next_idx+1}/{total_chunks})")
-                self.sock.sendto(packets[next_idx].to_bytes(), self.server_addr)
+                print(f"[>] Sending DATA seq {base_seq + next_idx} ({next_idx+1}/{total_chunks})")
+                wire[next_idx] = packets[next_idx].to_bytes()
+                batch.append(wire[next_idx])
+                send_time[next_idx] = now
                 next_idx += 1
+            send_batch(self.sock, batch, self.server_addr)
             
-            if next_idx == base:
-                last_send_time = time.time()
+            # Wait for ACKs no longer than the earliest in-flight packet's timer
+            oldest = min(send_time[i] for i in range(base, next_idx) if i not in acked)
+            if sel.select(timeout=max(oldest + TIMEOUT - time.time(), 0)):
+                for data, _ in recv_batch(self.sock, recv_slots):
+                    try:
+                        ack_pkt = Packet.from_bytes(data)
+                    except ValueError as e:
+                        print(f"[!] Invalid packet received: {e}")
+                        continue
+                    
+                    if ack_pkt.session_id != self.session_id or ack_pkt.msg_type != TYPE_ACK:
+                        continue
+                    
+                    acked_idx = ack_pkt.seq_num - base_seq
+                    if base <= acked_idx < next_idx:
+                        acked.add(acked_idx)
+                        # Slide the window past every contiguously ACKed packet
+                        while base in acked:
+                            acked.discard(base)
+                            wire[base] = packets[base] = None
+                            base += 1
             
-            try:
-                data, _ = self.sock.recvfrom(MAX_PAYLOAD_SIZE + HEADER_SIZE)
-                ack_pkt = Packet.from_bytes(data)
-                
-                if ack_pkt.session_id != self.session_id:
-                    continue
-                
-                if ack_pkt.msg_type == TYPE_ACK:
-                    acked_seq = ack_pkt.seq_num
-                    acked_idx = acked_seq - base_seq
-                    if 0 <= acked_idx < total_chunks and acked_idx >= base:
-                        base = acked_idx + 1  # Advance window base (cumulative ACK)
-                        last_send_time = time.time()
-                        
-            except socket.timeout:
-                # Timeout: Go-Back-N — retransmit from base
-                print(f"[!] Timeout waiting for ACK {packets[base].seq_num}. Retransmitting from seq {packets[base].seq_num}...")
-                next_idx = base  # Reset next send pointer to window base
+            # Selective Repeat — retransmit only the expired, unACKed packets
+            now = time.time()
+            batch = []
+            for i in range(base, next_idx):
+                if i not in acked and now - send_time[i] >= TIMEOUT:
+                    print(f"[!] Timeout waiting for ACK {base_seq + i}. Retransmitting seq {base_seq + i}...")
+                    batch.append(wire[i])
+                    send_time[i] = now
+            send_batch(self.sock, batch, self.server_addr)
+        
+        sel.close()
         
         # Update seq_num to after the last chunk
         self.seq_num = base_seq + total_chunks
         self.send_fin()
+        return True
 
     def send_fin(self):
         fin_pkt = Packet(TYPE_FIN, self.seq_num, self.session_id)
@@ -192,21 +247,74 @@ class UDPClient:
                 print("[!] Timeout waiting for FIN ACK. Retransmitting FIN...")
 
 
+def _upload_segment(host, port, filename, segment=None):
+    """Worker for parallel_upload: upload one byte range over its own socket and session."""
+    client = UDPClient(host, port)
+    try:
+        return client.upload_file(filename, segment=segment)
+    finally:
+        client.sock.close()
+
+def parallel_upload(host, port, filename, parallelism):
+    """
+    Upload a file as `parallelism` contiguous segments, each in its own process
+    with its own socket and session, so packet building and sending for the
+    segments runs concurrently rather than under one interpreter's GIL.
+    Returns True only if every segment was uploaded.
+    """
+    if not os.path.exists(filename):
+        print(f"[!] File not found: {filename}")
+        return False
+        
+    filesize = os.path.getsize(filename)
+    total_chunks = (filesize + MAX_PAYLOAD_SIZE - 1) // MAX_PAYLOAD_SIZE
+    if parallelism <= 1 or total_chunks <= 1:
+        return _upload_segment(host, port, filename)
+        
+    # Split on packet boundaries so only the final segment has a short last packet
+    seg_size = -(-total_chunks // parallelism) * MAX_PAYLOAD_SIZE
+    segments = [(off, min(seg_size, filesize - off)) for off in range(0, filesize, seg_size)]
+    
+    print(f"[*] Uploading '{filename}' as {len(segments)} parallel segments...")
+    with multiprocessing.Pool(len(segments)) as pool:
+        results = pool.starmap(_upload_segment, [(host, port, filename, seg) for seg in segments])
+    
+    failed = [seg for seg, ok in zip(segments, results) if not ok]
+    for offset, length in failed:
+        print(f"[!] Segment at offset {offset} ({length} bytes) failed to upload")
+    if failed:
+        print(f"[!] Upload of '{filename}' incomplete: {len(failed)} of {len(segments)} segments failed")
+        return False
+    print(f"[*] Parallel upload of '{filename}' complete.")
+    return True
+
+
 if __name__ == "__main__":
+    usage = "Usage: python client.py <host> <port> <upload|download> <filename> [--parallelism P]"
     if len(sys.argv) < 5:
-        print("Usage: python client.py <host> <port> <upload|download> <filename>")
+        print(usage)
         sys.exit(1)
         
     h = sys.argv[1]
     p = int(sys.argv[2])
     op = sys.argv[3].upper()
     file_name = sys.argv[4]
-    
-    client = UDPClient(h, p)
+    parallelism = 1
+    options = sys.argv[5:]
+    if options:
+        if len(options) != 2 or options[0] != "--parallelism" or not options[1].isdigit() or int(options[1]) < 1:
+            print(usage)
+            sys.exit(1)
+        parallelism = int(options[1])
     
     if op == "DOWNLOAD":
-        client.download_file(file_name)
+        UDPClient(h, p).download_file(file_name)
     elif op == "UPLOAD":
-        client.upload_file(file_name)
+        if parallelism > 1:
+            ok = parallel_upload(h, p, file_name, parallelism)
+        else:
+            ok = UDPClient(h, p).upload_file(file_name)
+        if not ok:
+            sys.exit(1)
     else:
         print("Invalid operation. Must be 'upload' or 'download'")
@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+
+# Batched datagram I/O. On Linux, sendmmsg(2)/recvmmsg(2) move a whole batch
+# of datagrams to or from the kernel in a single syscall; elsewhere we fall
+# back to one sendto()/recvfrom() per datagram.
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+def _load_libc():
+    path = ctypes.util.find_library("c")
+    if path is None:
+        return None
+    try:
+        libc = ctypes.CDLL(path, use_errno=True)
+        libc.sendmmsg
+        libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+    return libc
+
+_libc = _load_libc()
+HAVE_MMSG = _libc is not None
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+# Packed sockaddr_in per destination, so addresses are only resolved once
+_sockaddr_cache = {}
+
+def _sockaddr_in(addr):
+    sa = _sockaddr_cache.get(addr)
+    if sa is None:
+        host, port = addr
+        # struct sockaddr_in: family (host order), port (network order), address, zero padding
+        raw = (struct.pack('=H', socket.AF_INET) + struct.pack('!H', port)
+               + socket.inet_aton(socket.gethostbyname(host)) + bytes(8))
+        sa = ctypes.create_string_buffer(raw, len(raw))
+        _sockaddr_cache[addr] = sa
+    return sa
+
+def _buffer_address(buf):
+    """Return the address of a bytes or writable buffer's data, without copying it."""
+    if isinstance(buf, bytes):
+        return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+def send_batch(sock, buffers, addr):
+    """Send every buffer in `buffers` as its own datagram to `addr`."""
+    if not buffers:
+        return
+    if not HAVE_MMSG or sock.family != socket.AF_INET:
+        for buf in buffers:
+            sock.sendto(buf, addr)
+        return
+
+    n = len(buffers)
+    sa = _sockaddr_in(addr)
+    iovs = (_IOVec * n)()
+    msgs = (_MMsgHdr * n)()
+    for i, buf in enumerate(buffers):
+        iovs[i].iov_base = _buffer_address(buf)
+        iovs[i].iov_len = len(buf)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(sa)
+        hdr.msg_namelen = ctypes.sizeof(sa)
+        hdr.msg_iov = ctypes.pointer(iovs[i])
+        hdr.msg_iovlen = 1
+
+    # sendmmsg may send fewer messages than requested; resubmit the rest
+    sent = 0
+    fd = sock.fileno()
+    while sent < n:
+        ret = _libc.sendmmsg(fd, ctypes.addressof(msgs) + sent * ctypes.sizeof(_MMsgHdr), n - sent, 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Sockets with a timeout are non-blocking underneath; let
+                # sendto() wait for buffer space for the remainder.
+                for buf in buffers[sent:]:
+                    sock.sendto(buf, addr)
+                return
+            raise OSError(err, os.strerror(err))
+        sent += ret
+
+
+def send_vectored(sock, buffers, addr):
+    """Send `buffers` as one datagram to `addr`, gathered by the kernel (sendmsg)."""
+    if hasattr(sock, 'sendmsg'):
+        sock.sendmsg(buffers, [], 0, addr)
+    else:
+        sock.sendto(b"".join(buffers), addr)
+
+class RecvSlots:
+    """
+    Preallocated recvmmsg() vectors: one data buffer and sockaddr per slot.
+    Each receive loop owns its own RecvSlots; they must not be shared between
+    sockets or threads, since recv_batch() overwrites them on every call.
+    """
+    def __init__(self, count, bufsize):
+        self.count = count
+        self.bufsize = bufsize
+        self.bufs = [ctypes.create_string_buffer(bufsize) for _ in range(count)]
+        self.names = [ctypes.create_string_buffer(16) for _ in range(count)]  # sockaddr_in
+        self.iovs = (_IOVec * count)()
+        self.msgs = (_MMsgHdr * count)()
+        for i in range(count):
+            self.iovs[i].iov_base = ctypes.addressof(self.bufs[i])
+            self.iovs[i].iov_len = bufsize
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            hdr.msg_iovlen = 1
+
+def recv_batch(sock, slots):
+    """
+    Receive up to `slots.count` datagrams that are already queued on `sock`
+    into the caller's RecvSlots, returning a list of (data, addr) pairs.
+    Call once the socket is readable.
+    """
+    if not HAVE_MMSG or sock.family != socket.AF_INET:
+        return [sock.recvfrom(slots.bufsize)]
+
+    for i in range(slots.count):
+        # The kernel overwrites msg_namelen with the actual address length
+        slots.msgs[i].msg_hdr.msg_namelen = 16
+
+    while True:
+        ret = _libc.recvmmsg(sock.fileno(), ctypes.addressof(slots.msgs), slots.count, MSG_DONTWAIT, None)
+        if ret >= 0:
+            break
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return []
+        raise OSError(err, os.strerror(err))
+
+    packets = []
+    for i in range(ret):
+        name = slots.names[i].raw
+        addr = (socket.inet_ntoa(name[4:8]), struct.unpack('!H', name[2:4])[0])
+        # Copy exactly the received bytes out of the slot (.raw would first copy
+        # the whole slot, and slicing it would copy again)
+        packets.append((ctypes.string_at(slots.bufs[i], slots.msgs[i].msg_len), addr))
+    return packets
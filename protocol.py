@@ -1,5 +1,5 @@
 import struct
-import hashlib
+import zlib
 
 # Message Types
 TYPE_SYN = 0
@@ -11,10 +11,19 @@ TYPE_FIN_ACK = 5
 TYPE_ERROR = 6
 
 # Constants
-MAX_PAYLOAD_SIZE = 1024  # Max size of data payload
-HEADER_SIZE = 12         # 1(Type) + 4(Seq) + 4(SessionID) + 2(Len) + 1(Checksum)
+MAX_PAYLOAD_SIZE = 1400  # Max size of data payload (1415 B datagram fits a 1500 B Ethernet MTU)
+HEADER_SIZE = 15         # 1(Type) + 4(Seq) + 4(SessionID) + 2(Len) + 4(Checksum)
+
+# Precompiled header layouts, so the format string is not re-parsed per packet
+_HDR = struct.Struct('!B I I H I')       # full header
+_HDR_NOCK = struct.Struct('!B I I H')    # header without checksum
+_U32 = struct.Struct('!I')               # single SeqNum / Checksum field
 
 class Packet:
+    # Fixed attribute slots: faster attribute access and no per-instance __dict__
+    __slots__ = ('msg_type', 'seq_num', 'session_id', 'payload',
+                 'payload_length', 'checksum', '_bytes')
+
     def __init__(self, msg_type, seq_num, session_id, payload=b""):
         self.msg_type = msg_type
         self.seq_num = seq_num
@@ -22,34 +31,64 @@ class Packet:
         self.payload = payload
         self.payload_length = len(payload)
         self.checksum = self._calculate_checksum()
+        self._bytes = None  # Serialized form, built on first to_bytes() call
 
     def _calculate_checksum(self):
         """
-        Calculate an MD5-based checksum over the header and payload.
-        The digest is truncated to 1 byte to fit the packet's checksum field.
+        Calculate a CRC-32 checksum over the header and payload.
+        zlib.crc32 runs in C (hardware-accelerated where available) and,
+        unlike a byte-wise XOR, also detects reordered bytes.
         """
         # Pack header without checksum
-        header = struct.pack('!B I I H', self.msg_type, self.seq_num, self.session_id, self.payload_length)
+        header = _HDR_NOCK.pack(self.msg_type, self.seq_num, self.session_id, self.payload_length)
 
-        # Compute MD5 over header + payload, take first byte
-        digest = hashlib.md5(header + self.payload).digest()
-        return digest[0]
+        # Compute CRC-32 over header + payload incrementally (no concatenation).
+        # Control packets (ACK, FIN, FIN-ACK) have no payload: checksum the header only.
+        checksum = zlib.crc32(header)
+        if self.payload_length:
+            checksum = zlib.crc32(self.payload, checksum)
+        return checksum
 
     def to_bytes(self):
-        """Serialize the packet to a byte string for network transmission."""
+        """
+        Serialize the packet to a bytearray for network transmission.
+        The result is cached, so retransmitting the same Packet does not
+        re-serialize it.
+        """
+        if self._bytes is not None:
+            return self._bytes
+
         # ! indicates network byte order (big-endian)
         # B = unsigned char (1 byte) Type
         # I = unsigned int (4 bytes) SeqNum
         # I = unsigned int (4 bytes) SessionID
         # H = unsigned short (2 bytes) PayloadLen
-        # B = unsigned char (1 byte) Checksum
-        header = struct.pack('!B I I H B', 
-                             self.msg_type, 
-                             self.seq_num, 
-                             self.session_id, 
-                             self.payload_length, 
-                             self.checksum)
-        return header + self.payload
+        # I = unsigned int (4 bytes) Checksum
+        # Pack the header straight into a preallocated buffer and copy the
+        # payload in after it, instead of concatenating header + payload.
+        buf = bytearray(HEADER_SIZE + self.payload_length)
+        _HDR.pack_into(buf, 0,
+                       self.msg_type,
+                       self.seq_num,
+                       self.session_id,
+                       self.payload_length,
+                       self.checksum)
+        buf[HEADER_SIZE:] = self.payload
+        self._bytes = buf
+        return buf
+
+    def to_buffers(self):
+        """
+        Return the packet as separate (header, payload) buffers for a
+        scatter-gather send, so the payload is never copied into a combined
+        wire buffer.
+        """
+        header = _HDR.pack(self.msg_type,
+                           self.seq_num,
+                           self.session_id,
+                           self.payload_length,
+                           self.checksum)
+        return (header, self.payload)
 
     @classmethod
     def from_bytes(cls, data):
@@ -57,18 +96,49 @@ class Packet:
         if len(data) < HEADER_SIZE:
             raise ValueError("Packet too short")
 
-        header = data[:HEADER_SIZE]
-        payload = data[HEADER_SIZE:]
-
-        msg_type, seq_num, session_id, payload_length, received_checksum = struct.unpack('!B I I H B', header)
+        msg_type, seq_num, session_id, payload_length, received_checksum = _HDR.unpack_from(data)
 
         # Truncate payload if it's longer than stated in header (safety)
-        payload = payload[:payload_length]
+        payload = data[HEADER_SIZE:HEADER_SIZE + payload_length]
+
+        # Verify the checksum directly over the received header bytes and payload,
+        # instead of reconstructing a Packet (and re-packing its header) to do it
+        checksum = zlib.crc32(data[:_HDR_NOCK.size])
+        if payload:
+            checksum = zlib.crc32(payload, checksum)
 
-        # Reconstruct packet to verify checksum
-        packet = cls(msg_type, seq_num, session_id, payload)
-        
-        if packet.checksum != received_checksum:
-            raise ValueError(f"Checksum mismatch! Expected {packet.checksum}, got {received_checksum}")
+        if checksum != received_checksum:
+            raise ValueError(f"Checksum mismatch! Expected {checksum}, got {received_checksum}")
 
+        packet = cls.__new__(cls)
+        packet.msg_type = msg_type
+        packet.seq_num = seq_num
+        packet.session_id = session_id
+        packet.payload = payload
+        packet.payload_length = len(payload)
+        packet.checksum = checksum
+        packet._bytes = None
         return packet
+
+
+class AckTemplate:
+    """
+    Pre-packed header for one session's header-only ACK packets.
+    Type, SessionID and PayloadLen never change within a session, so they are
+    packed once; build() only patches the SeqNum and Checksum fields in place.
+    """
+    __slots__ = ('_buf',)
+
+    def __init__(self, session_id, msg_type=TYPE_ACK):
+        self._buf = bytearray(HEADER_SIZE)
+        _HDR_NOCK.pack_into(self._buf, 0, msg_type, 0, session_id, 0)
+
+    def build(self, seq_num):
+        """
+        Return the wire bytes of the ACK for seq_num. The buffer is reused by
+        the next build() call, so send it before building another.
+        """
+        buf = self._buf
+        _U32.pack_into(buf, 1, seq_num)
+        _U32.pack_into(buf, _HDR_NOCK.size, zlib.crc32(buf[:_HDR_NOCK.size]))
+        return buf
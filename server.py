@@ -1,14 +1,22 @@
+import heapq
+import mmap
+import selectors
 import socket
 import struct
 import time
 import os
 import random
 from protocol import *
+from netio import RecvSlots, recv_batch, send_vectored
 
 # Server settings
 HOST = '0.0.0.0'
 PORT = 8080
 TIMEOUT = 2.0  # seconds
+RECV_BATCH = 64  # max datagrams pulled per recvmmsg call
+MAX_RETRANSMITS = 30  # consecutive unanswered retransmits (~60 s) before a session is reaped
+UPLOAD_IDLE_TIMEOUT = MAX_RETRANSMITS * TIMEOUT  # seconds without DATA/FIN before an upload is reaped
+MAX_SESSIONS = 1 << 16  # session slots; the wire session ID is (slot << 16) | generation
 SERVER_DIR = 'server_data'
 
 class UDPServer:
@@ -25,26 +33,45 @@ class UDPServer:
         print(f"[*] Operating directory: '{SERVER_DIR}/'")
         
         # State tracking per session
-        self.sessions = {} # session_id -> { 'state', 'seq_num', 'file_obj', 'expected_seq' }
+        # Indexed by slot = session_id >> 16; None marks a free slot
+        self.sessions = [None] * MAX_SESSIONS # slot -> { 'session_id', 'state', 'seq_num', 'file_obj'/'data', 'expected_seq' }
+        self.free_slots = list(range(MAX_SESSIONS - 1, -1, -1))
+        self.generation = 0
+        # (client addr, client-chosen session ID) -> assigned session ID; only consulted for SYNs
+        self.syn_index = {}
+        
+        # Read-only mappings of files being downloaded, shared by every DOWNLOAD
+        # session on the same file: filepath -> [memoryview, session refcount]
+        self.file_cache = {}
+        
+        # recvmmsg buffers owned by this server's receive loop
+        self.recv_slots = RecvSlots(RECV_BATCH, MAX_PAYLOAD_SIZE + HEADER_SIZE)
+        
+        # Pending retransmissions: min-heap of (deadline, session_id, seq_num)
+        self.retx_heap = []
         
         # simulated packet loss (%)
         self.drop_rate = 0.0
 
     def start(self):
+        # Wait for readability with a selector rather than a blocking recvfrom, and
+        # wake exactly when the earliest retransmission deadline falls due.
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        
         while True:
-            try:
-                data, addr = self.sock.recvfrom(MAX_PAYLOAD_SIZE + HEADER_SIZE)
-                
-                # simulate packet loss
-                if random.random() < self.drop_rate:
-                    print(f"[!] Simulating packet drop from {addr}")
-                    continue
-                    
-                self.handle_packet(data, addr)
-                
-            except socket.timeout:
-                # server timeout check (e.g., waiting for FIN-ACK but timed out)
-                self.check_timeouts()
+            timeout = max(self.retx_heap[0][0] - time.time(), 0) if self.retx_heap else None
+            if sel.select(timeout=timeout):
+                for data, addr in recv_batch(self.sock, self.recv_slots):
+                    # simulate packet loss
+                    if random.random() < self.drop_rate:
+                        print(f"[!] Simulating packet drop from {addr}")
+                        continue
+                        
+                    self.handle_packet(data, addr)
+            
+            # server timeout check (e.g., waiting for FIN-ACK but timed out)
+            self.check_timeouts()
 
     def handle_packet(self, data, addr):
         try:
@@ -53,17 +80,17 @@ class UDPServer:
             
             if packet.msg_type == TYPE_SYN:
                 self.handle_syn(packet, addr)
-            elif packet.session_id in self.sessions:
-                session = self.sessions[packet.session_id]
-                
-                if packet.msg_type == TYPE_DATA:
-                    self.handle_data(packet, addr, session)
-                elif packet.msg_type in (TYPE_ACK, TYPE_FIN_ACK):
-                    self.handle_ack(packet, addr, session)
-                elif packet.msg_type == TYPE_FIN:
-                    self.handle_fin(packet, addr, session)
-            else:
+                return
+            
+            session = self.get_session(packet.session_id)
+            if session is None:
                 print(f"[!] Received packet for unknown session {packet.session_id}")
+            elif packet.msg_type == TYPE_DATA:
+                self.handle_data(packet, addr, session)
+            elif packet.msg_type in (TYPE_ACK, TYPE_FIN_ACK):
+                self.handle_ack(packet, addr, session)
+            elif packet.msg_type == TYPE_FIN:
+                self.handle_fin(packet, addr, session)
                 
         except ValueError as e:
             print(f"[!] Checksum or parsing error from {addr}: {e}")
@@ -71,15 +98,33 @@ class UDPServer:
     def handle_syn(self, packet, addr):
         # A SYN packet expects the payload to contain the operation (upload/download) and filename.
         # Format: "UPLOAD<sep>filename.ext" or "DOWNLOAD<sep>filename.ext"
+        # A parallel upload segment uses its own op, with its byte offset and the total
+        # file size ahead of the filename: "UPLOAD_SEG<sep>offset<sep>total<sep>filename.ext"
         payload_str = packet.payload.decode('utf-8')
         try:
             op, filename = payload_str.split('|', 1)
+            segment = None
+            if op == "UPLOAD_SEG":
+                offset, total, filename = filename.split('|', 2)
+                if not (offset.isdigit() and total.isdigit()):
+                    raise ValueError
+                op, segment = "UPLOAD", (int(offset), int(total))
         except ValueError:
             self.send_error(packet.session_id, addr, packet.seq_num + 1, b"Invalid SYN payload format")
             return
 
-        session_id = packet.session_id
-        
+        client_session_id = packet.session_id
+        syn_key = (addr, client_session_id)
+        session_id = self.syn_index.get(syn_key)
+        if session_id is not None:
+            if self.sessions[session_id >> 16]['syn_payload'] == packet.payload:
+                # Duplicate or retransmitted SYN (our SYN-ACK was lost or delayed): the
+                # session is already running, so repeat the SYN-ACK with its assigned ID
+                self.send_syn_ack(packet, addr, session_id)
+                return
+            # The same client ID now asks for a different transfer; replace the old session
+            self.close_session(session_id)
+
         # Secure the filename against directory traversal attacks
         secure_filename = os.path.basename(filename)
         filepath = os.path.join(SERVER_DIR, secure_filename)
@@ -87,42 +132,136 @@ class UDPServer:
         # Initialize session state based on operation
         if op == "DOWNLOAD":
             if not os.path.exists(filepath):
-                self.send_error(session_id, addr, packet.seq_num + 1, b"File not found")
+                self.send_error(client_session_id, addr, packet.seq_num + 1, b"File not found")
+                return
+            
+            session_id = self.allocate_session(addr, client_session_id, packet.seq_num)
+            if session_id is None:
                 return
             
             print(f"[*] Starting DOWNLOAD for {secure_filename}, Session: {session_id}")
             syn_ack_seq = packet.seq_num + 1
-            self.sessions[session_id] = {
+            self.sessions[session_id >> 16] = {
+                'session_id': session_id,
+                'syn_key': syn_key,
+                'syn_payload': bytes(packet.payload),
                 'addr': addr,
                 'state': 'TRANSFERRING',
                 'op': 'DOWNLOAD',
-                'file_obj': open(filepath, 'rb'),
+                'filepath': filepath,
+                'data': self.map_file(filepath),
+                'offset': 0,
                 'seq_num': syn_ack_seq,  # Server's current seq (SYN-ACK seq)
                 'last_acked_seq': packet.seq_num,
                 'unacked_packet': None,
                 'last_send_time': 0,
+                'retransmits': 0,  # consecutive retransmits of unacked_packet
             }
             
             # Send SYN-ACK confirming we have the file
-            syn_ack = Packet(TYPE_SYN_ACK, syn_ack_seq, session_id, b"OK")
-            self.sock.sendto(syn_ack.to_bytes(), addr)
+            self.send_syn_ack(packet, addr, session_id)
             
             # Start sending first data packet immediately after SYN-ACK
             self.send_next_data(session_id)
             
         elif op == "UPLOAD":
+            if filepath in self.file_cache:
+                # Truncating a file that is mapped by active downloads would break them
+                self.send_error(client_session_id, addr, packet.seq_num + 1, b"File busy")
+                return
+            
+            session_id = self.allocate_session(addr, client_session_id, packet.seq_num)
+            if session_id is None:
+                return
+            
             print(f"[*] Starting UPLOAD for {secure_filename}, Session: {session_id}")
-            self.sessions[session_id] = {
+            self.sessions[session_id >> 16] = {
+                'session_id': session_id,
+                'syn_key': syn_key,
+                'syn_payload': bytes(packet.payload),
                 'addr': addr,
                 'state': 'TRANSFERRING',
                 'op': 'UPLOAD',
-                'file_obj': open(filepath, 'wb'),
+                'file_obj': self.open_upload(filepath, segment),
                 'expected_seq': packet.seq_num + 1,
                 'recv_buffer': {},  # seq_num -> payload for out-of-order buffering
+                'ack_template': AckTemplate(session_id),
+                'last_recv_time': time.time(),  # refreshed by every DATA packet
             }
+            # One idle-check entry per upload; check_timeouts re-arms it from last_recv_time
+            heapq.heappush(self.retx_heap, (time.time() + UPLOAD_IDLE_TIMEOUT, session_id, 0))
             # Send SYN-ACK
-            syn_ack = Packet(TYPE_SYN_ACK, packet.seq_num + 1, session_id, b"OK")
-            self.sock.sendto(syn_ack.to_bytes(), addr)
+            self.send_syn_ack(packet, addr, session_id)
+
+    def send_syn_ack(self, syn, addr, session_id):
+        """Answer a SYN, telling the client the session ID assigned to it ("OK|<session_id>")."""
+        syn_ack = Packet(TYPE_SYN_ACK, syn.seq_num + 1, syn.session_id, f"OK|{session_id}".encode('utf-8'))
+        self.sock.sendto(syn_ack.to_bytes(), addr)
+
+    def allocate_session(self, addr, client_session_id, syn_seq):
+        """
+        Reserve a free session slot and return the session ID assigned to it, or None
+        (after sending an ERROR) if every slot is in use. The low 16 bits carry the
+        server-wide generation counter, which keeps a recycled slot from accepting
+        packets of the session that used it before.
+        """
+        if not self.free_slots:
+            self.send_error(client_session_id, addr, syn_seq + 1, b"Server busy")
+            return None
+        slot = self.free_slots.pop()
+        self.generation = self.generation % 0xFFFF + 1  # 1..65535
+        session_id = (slot << 16) | self.generation
+        self.syn_index[(addr, client_session_id)] = session_id
+        return session_id
+
+    def get_session(self, session_id):
+        """Return the live session for session_id, or None if it is unknown or stale."""
+        session = self.sessions[session_id >> 16]
+        if session is None or session['session_id'] != session_id:
+            return None
+        return session
+
+    def open_upload(self, filepath, segment):
+        """Open the destination of an upload; a segment writes in place at its offset."""
+        if segment is None:
+            return open(filepath, 'wb')
+        offset, total = segment
+        # Sibling segments share the file, so it must not be truncated to zero.
+        # Sizing it to the full length is a no-op for every segment after the first.
+        f = os.fdopen(os.open(filepath, os.O_WRONLY | os.O_CREAT, 0o644), 'wb')
+        f.truncate(total)
+        f.seek(offset)
+        return f
+
+    def map_file(self, filepath):
+        """Return a shared read-only memoryview of filepath, mapping it on first use."""
+        entry = self.file_cache.get(filepath)
+        if entry is None:
+            with open(filepath, 'rb') as f:
+                # mmap cannot map an empty file
+                if os.fstat(f.fileno()).st_size:
+                    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                else:
+                    data = memoryview(b"")
+            entry = self.file_cache[filepath] = [data, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def close_session(self, session_id):
+        """Release a session's file (upload handle or shared download mapping) and forget it."""
+        slot = session_id >> 16
+        session = self.sessions[slot]
+        self.sessions[slot] = None
+        self.free_slots.append(slot)
+        del self.syn_index[session['syn_key']]
+        if 'file_obj' in session:
+            session['file_obj'].close()
+        else:
+            entry = self.file_cache[session['filepath']]
+            entry[1] -= 1
+            if entry[1] == 0:
+                # The mapping is unmapped once the last payload slice is released
+                del self.file_cache[session['filepath']]
 
     def send_error(self, session_id, addr, seq_num, err_msg):
         err_pkt = Packet(TYPE_ERROR, seq_num, session_id, err_msg)
@@ -130,7 +269,7 @@ class UDPServer:
         print(f"[!] Sent ERROR to {addr}: {err_msg}")
 
     def send_next_data(self, session_id):
-        session = self.sessions[session_id]
+        session = self.sessions[session_id >> 16]
         if session['state'] != 'TRANSFERRING' or session['op'] != 'DOWNLOAD':
             return
             
@@ -138,7 +277,9 @@ class UDPServer:
              # Waiting for ACK on this packet still. The check_timeouts logic handles retransmission.
              return
 
-        data_chunk = session['file_obj'].read(MAX_PAYLOAD_SIZE)
+        # Slice the next chunk straight out of the shared mapping (no read() copy)
+        offset = session['offset']
+        data_chunk = session['data'][offset:offset + MAX_PAYLOAD_SIZE]
         
         if not data_chunk:
             # Reached EOF, initiate FIN
@@ -149,16 +290,20 @@ class UDPServer:
             session['state'] = 'FIN_WAIT'
             session['unacked_packet'] = fin_pkt
             session['last_send_time'] = time.time()
+            heapq.heappush(self.retx_heap, (session['last_send_time'] + TIMEOUT, session_id, fin_pkt.seq_num))
             return
             
         # Create and send data packet
         session['seq_num'] += 1
+        session['offset'] = offset + len(data_chunk)
         data_pkt = Packet(TYPE_DATA, session['seq_num'], session_id, data_chunk)
-        self.sock.sendto(data_pkt.to_bytes(), session['addr'])
+        # Header and payload go out as two iovecs; they are never concatenated
+        send_vectored(self.sock, data_pkt.to_buffers(), session['addr'])
         
         # Store packet to wait for ACK
         session['unacked_packet'] = data_pkt
         session['last_send_time'] = time.time()
+        heapq.heappush(self.retx_heap, (session['last_send_time'] + TIMEOUT, session_id, data_pkt.seq_num))
 
     def handle_ack(self, packet, addr, session):
         # We only really care about ACKs when we are DOWNLOADING (sending file to client)
@@ -166,6 +311,7 @@ class UDPServer:
             if session['unacked_packet'] and packet.seq_num == session['unacked_packet'].seq_num:
                 # The packet we sent was successfully received!
                 session['last_acked_seq'] = packet.seq_num
+                session['retransmits'] = 0
                 session['unacked_packet'] = None
                 
                 if session['state'] == 'TRANSFERRING':
@@ -173,20 +319,19 @@ class UDPServer:
                 elif session['state'] == 'FIN_WAIT':
                     # Received ACK for FIN. We are done!
                     print(f"[*] Received FIN-ACK for session {packet.session_id}. Closing.")
-                    session['file_obj'].close()
-                    del self.sessions[packet.session_id]
+                    self.close_session(packet.session_id)
 
     def handle_data(self, packet, addr, session):
         # We handle DATA packets when we are UPLOADING (receiving file from client)
         if session['op'] == 'UPLOAD' and session['state'] == 'TRANSFERRING':
+            session['last_recv_time'] = time.time()
             seq = packet.seq_num
             expected = session['expected_seq']
             
             if seq < expected:
                 # Duplicate packet — our ACK was probably lost; resend it
                 print(f"[!] Duplicate data pkt seq {seq}, resending ACK {seq}")
-                ack_pkt = Packet(TYPE_ACK, seq, packet.session_id)
-                self.sock.sendto(ack_pkt.to_bytes(), addr)
+                self.sock.sendto(session['ack_template'].build(seq), addr)
                 return
 
             # Buffer this packet (may be in-order or ahead)
@@ -199,11 +344,9 @@ class UDPServer:
                 session['file_obj'].write(payload)
                 session['expected_seq'] += 1
 
-            # Send cumulative ACK for the highest in-order seq delivered
-            ack_seq = session['expected_seq'] - 1
-            ack_pkt = Packet(TYPE_ACK, ack_seq, packet.session_id)
-            self.sock.sendto(ack_pkt.to_bytes(), addr)
-            print(f"[-] Sent cumulative ACK {ack_seq} (expected_seq now {session['expected_seq']})") 
+            # Selectively ACK the packet just received (buffered or delivered)
+            self.sock.sendto(session['ack_template'].build(seq), addr)
+            print(f"[-] Sent ACK {seq} (expected_seq now {session['expected_seq']})")
 
     def handle_fin(self, packet, addr, session):
         if session['op'] == 'UPLOAD':
@@ -213,40 +356,56 @@ class UDPServer:
             self.sock.sendto(ack_pkt.to_bytes(), addr)
             
             # Close file and finish
-            session['file_obj'].close()
-            del self.sessions[packet.session_id]
+            self.close_session(packet.session_id)
 
 
     def check_timeouts(self):
-        """Retransmit unacknowledged packets if timeout exceeded, and cleanup stale sessions."""
+        """
+        Retransmit unacknowledged packets whose deadline has passed, and cleanup stale sessions.
+        Only due heap entries are visited; entries for packets that were ACKed (or whose
+        session closed) since they were scheduled are simply discarded. UPLOAD sessions
+        send nothing to retransmit, so their single entry is an idle deadline instead.
+        """
         current_time = time.time()
-        stale_sessions = []
+        heap = self.retx_heap
         
-        for session_id, session in self.sessions.items():
-            last_activity = session.get('last_send_time', current_time)
+        while heap and heap[0][0] <= current_time:
+            _, session_id, seq_num = heapq.heappop(heap)
+            session = self.get_session(session_id)
+            if session is None:
+                continue
             
-            # Re-transmit logic
-            if session.get('unacked_packet'):
-                if current_time - last_activity > TIMEOUT:
-                    print(f"[!] Timeout! Retransmitting Seq: {session['unacked_packet'].seq_num}")
-                    try:
-                        self.sock.sendto(session['unacked_packet'].to_bytes(), session['addr'])
-                        session['last_send_time'] = current_time
-                    except Exception as e:
-                        print(f"[!] Error retransmitting: {e}")
-            
-            # Stale session cleanup (e.g., client crashed)
-            if current_time - last_activity > (TIMEOUT * 5):
+            if session['op'] == 'UPLOAD':
+                # Idle upload cleanup (e.g., client crashed mid-upload)
+                deadline = session['last_recv_time'] + UPLOAD_IDLE_TIMEOUT
+                if deadline > current_time:
+                    heapq.heappush(heap, (deadline, session_id, 0))
+                    continue
                 print(f"[!] Session {session_id} timed out and will be closed.")
-                stale_sessions.append(session_id)
-                
-        # Remove stale sessions
-        for session_id in stale_sessions:
+                self.send_error(session_id, session['addr'], session['expected_seq'], b"Session timed out")
+                self.close_session(session_id)
+                continue
+            
+            if session['unacked_packet'] is None or session['unacked_packet'].seq_num != seq_num:
+                continue
+            
+            # Stale session cleanup (e.g., client crashed): give up after MAX_RETRANSMITS
+            # unanswered retransmits, and tell the client so it does not wait forever
+            if session['retransmits'] >= MAX_RETRANSMITS:
+                print(f"[!] Session {session_id} timed out and will be closed.")
+                self.send_error(session_id, session['addr'], seq_num, b"Session timed out")
+                self.close_session(session_id)
+                continue
+            
+            # Re-transmit logic
+            print(f"[!] Timeout! Retransmitting Seq: {seq_num}")
+            session['retransmits'] += 1
             try:
-                self.sessions[session_id]['file_obj'].close()
-            except:
-                pass
-            del self.sessions[session_id]
+                send_vectored(self.sock, session['unacked_packet'].to_buffers(), session['addr'])
+                session['last_send_time'] = current_time
+            except Exception as e:
+                print(f"[!] Error retransmitting: {e}")
+            heapq.heappush(heap, (current_time + TIMEOUT, session_id, seq_num))
 
 if __name__ == "__main__":
     server = UDPServer(HOST, PORT)